@@ -6,18 +6,29 @@ Gmail Cleaner Pro - Профессиональный инструмент для
 """
 
 import os
+import sys
 import time
 import json
 import logging
 import re
-import argparse
 import webbrowser
 import math
 import random
 import base64
+import functools
+import gzip
+import importlib.util
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime, timezone, timedelta
-from typing import List, Tuple, Optional, Generator
+from operator import itemgetter
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, List, Tuple, Optional, Generator
 from email.utils import parsedate_to_datetime
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from googleapiclient.http import BatchHttpRequest
@@ -38,17 +49,36 @@ try:
 except ImportError:
     DATEUTIL_AVAILABLE = False
 
+try:
+    from rapidfuzz import fuzz as rf_fuzz, process as rf_process
+    import numpy as np
+    RAPIDFUZZ_AVAILABLE = True
+except ImportError:
+    RAPIDFUZZ_AVAILABLE = False
+
+try:
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    SCIPY_AVAILABLE = True
+except ImportError:
+    SCIPY_AVAILABLE = False
+
 try:
     from fuzzywuzzy import fuzz
     FUZZYWUZZY_AVAILABLE = True
 except ImportError:
     FUZZYWUZZY_AVAILABLE = False
 
-try:
+# pandas импортируется долго и нужен только интерактивному режиму — грузим лениво (см. _pd)
+PANDAS_AVAILABLE = importlib.util.find_spec('pandas') is not None
+if TYPE_CHECKING:
     import pandas as pd
-    PANDAS_AVAILABLE = True
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
 except ImportError:
-    PANDAS_AVAILABLE = False
+    ORJSON_AVAILABLE = False
 
 try:
     import pyperclip
@@ -66,14 +96,17 @@ except ImportError:
 DEFAULT_CONFIG = {
     'scopes': ['https://www.googleapis.com/auth/gmail.modify'],
     'batch_size': 100,
+    'list_page_size': 500,
     'batch_delete_size': 1000,
-    'delay_between_requests': 0.1,
-    'sleep_after_list': 0.2,
+    'quota_units_per_second': 250,
+    'quota_burst_units': 500,
+    'rate_limit_penalty_seconds': 30,
     'credentials_file': 'credentials.json',
     'token_file': 'token.json',
     'log_file': 'gmail_cleaner_pro.log',
     'backup_dir': 'email_backups',
     'stats_dir': 'stats',
+    'stats_pretty': False,
     'subject_similarity_threshold': 85,
     'max_retries': 5,
     'initial_backoff': 1.0,
@@ -81,8 +114,61 @@ DEFAULT_CONFIG = {
     'dry_run': False,
     'auto_backup': True,
     'use_batch_delete': True,
+    'fetch_workers': 4,
+    'http_timeout': 30,
+    'unsubscribe_cache_days': 30,
+    'top_senders_count': 50,
 }
 
+# Максимум подзапросов в одном batch-запросе Gmail API
+GMAIL_BATCH_LIMIT = 100
+
+# Максимум ID в одном запросе messages.batchModify
+GMAIL_BATCH_MODIFY_LIMIT = 1000
+
+# Стоимость запросов в единицах квоты Gmail API (лимит на пользователя — 250 в секунду)
+GMAIL_QUOTA_UNITS = {
+    'get': 5,
+    'list': 5,
+    'trash': 5,
+    'batch_modify': 50,
+}
+
+# Дата писем, у которых её не удалось разобрать (всегда один и тот же объект)
+_EPOCH_SENTINEL = datetime.min.replace(tzinfo=timezone.utc)
+
+# Сколько строк матрицы сходства тем считать за раз (ограничивает память)
+SIMILARITY_BLOCK_ROWS = 1000
+
+# umask процесса: файлы из tempfile.mkstemp (0600) получают права как у обычного open()
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# sender_counts.csv крупнее этого размера читается частями по SENDER_CSV_CHUNK_ROWS строк
+SENDER_CSV_CHUNK_BYTES = 50_000_000
+SENDER_CSV_CHUNK_ROWS = 50_000
+
+# === Скомпилированные регулярные выражения ===
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+_DOMAIN_RE = re.compile(r'^[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+_RFC2822_RE = re.compile(r'^(?:[A-Z][a-z]{2}, )?\d{1,2} [A-Z][a-z]{2} \d{4} ')
+_SUBJ_PREFIX_RE = re.compile(r'^(re|fwd|fw|aw):\s*', re.IGNORECASE)
+_SUBJ_COUNT_RE = re.compile(r'\s*[\(\[]\d+[\)\]]\s*$')
+_UNSUB_HEADER_RE = re.compile(r'<(https?://[^>]+)>')
+# (ключевое слово, шаблон): regex запускается, только если слово есть в тексте
+_UNSUB_BODY_RES = [
+    (keyword, re.compile(rf'(https?://[^\s]+{keyword}[^\s"<>]*)', re.IGNORECASE))
+    for keyword in ('unsubscribe', 'opt-out', 'remove')
+]
+# Числа из интерактивного ввода (float, как и раньше, допускает '5.' и '.5')
+_INT_RE = re.compile(r'\d+')
+_FLOAT_RE = re.compile(r'\d+\.?\d*|\.\d+')
+
+# === Баннеры консольного вывода ===
+_STARTUP_BANNER = "=" * 60 + "\n      📧 GMAIL CLEANER PRO v2.1 - Полностью рабочий скрипт 🚀\n" + "=" * 60
+_LOOP_BANNER = "\n" + "=" * 70 + "\n          ✨ ГОТОВНОСТЬ К ЧИСТКЕ (Введите 'q' для выхода)\n" + "=" * 70
+_STATS_RULE = "=" * 50
+
 
 def load_config(config_file: str = 'gmail_cleaner_config.json') -> dict:
     """Загружает конфигурацию из файла или возвращает дефолтную."""
@@ -109,6 +195,91 @@ def setup_logging(log_file: str):
             logging.StreamHandler()
         ]
     )
+
+
+@functools.lru_cache(maxsize=4096)
+def _clean_subject(subject: str) -> str:
+    """Очистка темы от префиксов Re/Fwd и счётчиков; рассылки повторяют темы, поэтому кэшируется."""
+    cleaned = _SUBJ_COUNT_RE.sub('', _SUBJ_PREFIX_RE.sub('', subject))
+    return cleaned.strip().lower()
+
+
+@functools.lru_cache(maxsize=None)
+def _pd():
+    """Ленивый импорт pandas (только при первом обращении)."""
+    import pandas
+    return pandas
+
+
+def _read_sender_parquet(pd, parquet_file: str, csv_mtime_ns: int) -> Optional['pd.DataFrame']:
+    """Чтение parquet-копии CSV отправителей, если она есть и не старше CSV; иначе None."""
+    try:
+        if os.stat(parquet_file).st_mtime_ns < csv_mtime_ns:
+            return None
+        return pd.read_parquet(parquet_file, columns=['sender_email', 'message_count'])
+    except Exception:
+        return None
+
+
+def _read_sender_csv(pd, filename: str, file_size: int, top_k: int) -> Tuple['pd.DataFrame', int]:
+    """Чтение CSV отправителей: (таблица, всего строк); небольшой файл заодно сохраняется в parquet."""
+    # Читаем только нужные колонки с заданными типами — без вывода типов по всему файлу
+    read_options = {
+        'usecols': ['sender_email', 'message_count'],
+        'dtype': {'sender_email': 'string', 'message_count': 'Int64'},
+    }
+    
+    if file_size > SENDER_CSV_CHUNK_BYTES:
+        # Большой файл целиком в память не грузим: из каждой части берём только топ-K
+        total = 0
+        tops = []
+        for chunk in pd.read_csv(filename, chunksize=SENDER_CSV_CHUNK_ROWS, engine='c', **read_options):
+            chunk['message_count'] = chunk['message_count'].fillna(0)
+            total += len(chunk)
+            tops.append(chunk.nlargest(top_k, 'message_count'))
+        return pd.concat(tops, ignore_index=True), total
+    
+    try:
+        # Многопоточный разбор pyarrow (chunksize он не поддерживает)
+        df = pd.read_csv(filename, engine='pyarrow', **read_options)
+    except (ImportError, ValueError, KeyError):
+        # pyarrow не установлен или не справился (нет колонки — ArrowKeyError, это KeyError) —
+        # C-движок, его ошибки уйдут выше
+        df = pd.read_csv(filename, engine='c', **read_options)
+    df['message_count'] = df['message_count'].fillna(0)
+    
+    try:
+        df.to_parquet(filename + '.parquet', index=False)
+    except Exception as e:
+        # Нет pyarrow/fastparquet или нет прав на запись — просто читаем CSV в следующий раз
+        logging.getLogger(__name__).debug("Parquet-копия не сохранена: %s", e)
+    
+    return df, len(df)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_top_senders(filename: str, mtime_ns: int, file_size: int, top_k: int) -> Tuple['pd.DataFrame', int]:
+    """Топ-K отправителей и их общее число.
+    
+    Кэшируется по (путь, mtime, размер, K): повторная загрузка неизменённого файла
+    (например, при новом запуске main() в том же процессе) не перечитывает его.
+    Исключения не кэшируются.
+    """
+    pd = _pd()
+    
+    # Parquet-копия CSV из прошлого запуска читается на порядки быстрее
+    df = _read_sender_parquet(pd, filename + '.parquet', mtime_ns)
+    if df is not None:
+        total = len(df)
+    else:
+        df, total = _read_sender_csv(pd, filename, file_size, top_k)
+    
+    # Показываются только самые активные: частичный отбор вместо полной сортировки
+    df = df.nlargest(top_k, 'message_count')
+    # Нумерация строк для вывода; в отличие от reset_index не копирует таблицу
+    df.index = pd.RangeIndex(len(df))
+    return df, total
+
     
 def display_top_senders(df: 'pd.DataFrame'):
     """Выводит топ-10 самых активных отправителей."""
@@ -127,6 +298,51 @@ def display_top_senders(df: 'pd.DataFrame'):
     print("-----------------------------------------------------------------")
 
 
+class _TokenBucket:
+    """Потокобезопасный ограничитель скорости по квоте Gmail API.
+
+    Пока квоты хватает, запросы уходят без задержек. После rate limit все потоки
+    выжидают паузу, а скорость на время штрафа снижается вдвое.
+    """
+    __slots__ = ('rate', 'capacity', 'penalty_seconds', 'tokens', 'updated', 'penalty_until', 'lock')
+
+    def __init__(self, rate: float, capacity: float, penalty_seconds: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.penalty_seconds = penalty_seconds
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.penalty_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> float:
+        """Начисление токенов за прошедшее время; возвращает текущую скорость."""
+        rate = self.rate / 2 if now < self.penalty_until else self.rate
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return rate
+
+    def consume(self, cost: float):
+        """Списание cost единиц квоты; ждёт, только если их не хватает."""
+        cost = min(cost, self.capacity)
+        while True:
+            with self.lock:
+                rate = self._refill(time.monotonic())
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                wait_time = (cost - self.tokens) / rate
+            time.sleep(wait_time)
+
+    def penalize(self, pause: float):
+        """Реакция на rate limit: ближайшие pause секунд токены не начисляются, затем скорость вдвое ниже."""
+        with self.lock:
+            now = time.monotonic()
+            self.penalty_until = now + pause + self.penalty_seconds
+            rate = self._refill(now)
+            self.tokens = min(self.tokens, -pause * rate)
+
+
 class GmailCleanerPro:
     """Профессиональный менеджер для чистки Gmail."""
     
@@ -138,6 +354,18 @@ class GmailCleanerPro:
         setup_logging(self.config['log_file'])
         self.logger = logging.getLogger(__name__)
         self.service = None
+        self.creds = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._bucket = _TokenBucket(
+            self.config['quota_units_per_second'],
+            self.config['quota_burst_units'],
+            self.config['rate_limit_penalty_seconds']
+        )
+        # Пулы живут всё время работы, чтобы потоки (и их клиенты API) переиспользовались
+        self._fetch_executor = ThreadPoolExecutor(max_workers=self.config['fetch_workers'])
+        self._list_executor = ThreadPoolExecutor(max_workers=1)
+        self._meta_db = self._open_metadata_cache()
         self.stats = {
             'found': 0,
             'trashed': 0,
@@ -147,10 +375,26 @@ class GmailCleanerPro:
         }
         self.messages_cache: List[Tuple[datetime, str, str]] = []
 
+    def close(self):
+        """Остановка пулов потоков и закрытие кэша метаданных."""
+        # Пачки из очереди не запускаем (например, после Ctrl+C) — ждём только уже идущие
+        self._fetch_executor.shutdown(wait=True, cancel_futures=True)
+        self._list_executor.shutdown(wait=True, cancel_futures=True)
+        self._meta_db.close()
+
+    def __enter__(self) -> 'GmailCleanerPro':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     # ==================== АУТЕНТИФИКАЦИЯ ====================
     
     def authenticate_gmail_api(self):
         """Аутентификация в Gmail API."""
+        if self.service is not None and self.creds is not None and self.creds.valid:
+            return
+        
         creds = None
         
         if os.path.exists(self.config['token_file']):
@@ -187,45 +431,98 @@ class GmailCleanerPro:
             with open(self.config['token_file'], 'w', encoding='utf-8') as token:
                 token.write(creds.to_json())
 
-        self.service = build('gmail', 'v1', credentials=creds)
+        self.creds = creds
+        self.service = self._build_service(creds)
         self.logger.info("✅ Успешная аутентификация в Gmail API")
 
+    def _build_service(self, creds):
+        """Клиент Gmail API с одним keep-alive HTTP-соединением на все запросы.
+        
+        Discovery-документ берётся из копии внутри googleapiclient, без сетевого запроса.
+        """
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=self.config['http_timeout']))
+        return build('gmail', 'v1', http=http, cache_discovery=False, static_discovery=True)
+
+    def _thread_service(self):
+        """Клиент Gmail API для текущего потока (googleapiclient не потокобезопасен)."""
+        if threading.current_thread() is threading.main_thread():
+            return self.service
+        
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = self._build_service(self.creds)
+            self._local.service = service
+        return service
+
     # ==================== УТИЛИТЫ ====================
     
     @staticmethod
     def validate_email(email: str) -> bool:
         """Валидация email адреса."""
-        # ИСПРАВЛЕНО: закрывающая кавычка и скобка
-        pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$' 
-        return re.match(pattern, email) is not None
+        # Быстрый отсев без regex: нет '@' или он первый/последний символ
+        at = email.rfind('@')
+        if at <= 0 or at == len(email) - 1:
+            return False
+        return _EMAIL_RE.match(email) is not None
+
+    @staticmethod
+    def extract_address(sender: str) -> str:
+        """Адрес из строки вида '"Имя" <user@host>' (как в заголовке From)."""
+        lt = sender.rfind('<')
+        gt = sender.rfind('>')
+        if lt != -1 and gt > lt:
+            return sender[lt + 1:gt].strip()
+        return sender
 
     @staticmethod
     def validate_domain(domain: str) -> bool:
         """Валидация домена."""
-        # Добавлен вспомогательный метод для проверки домена
-        pattern = r'^[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$' 
-        return re.match(pattern, domain) is not None
+        return _DOMAIN_RE.match(domain) is not None
 
-    def exponential_backoff(self, attempt: int) -> float:
-        """Экспоненциальная задержка с jitter."""
+    def exponential_backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Экспоненциальная задержка с jitter (не меньше Retry-After от сервера)."""
         base_delay = self.config['initial_backoff'] * (2 ** attempt)
         delay = min(base_delay, self.config['max_backoff'])
         jitter = delay * 0.2 * (random.random() - 0.5)
+        if retry_after is not None:
+            # Сервер сам назвал время ожидания: ждём его плюс jitter,
+            # чтобы параллельные потоки не повторили запросы синхронно
+            return retry_after + abs(jitter)
         return delay + jitter
 
+    @staticmethod
+    def get_retry_after(error: HttpError) -> Optional[float]:
+        """Значение заголовка Retry-After (секунды или HTTP-дата) из ответа API."""
+        value = error.resp.get('retry-after') if error.resp is not None else None
+        if not value:
+            return None
+        
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        
+        try:
+            retry_at = parsedate_to_datetime(value)
+            return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
     def parse_email_date(self, date_str: str) -> datetime:
         """Парсинг даты из заголовка письма."""
         if not date_str:
-            return datetime.min.replace(tzinfo=timezone.utc)
+            return _EPOCH_SENTINEL
         
-        try:
-            dt = parsedate_to_datetime(date_str)
-            if dt and dt.tzinfo is None:
-                dt = dt.replace(tzinfo=timezone.utc)
-            return dt
-        except Exception:
-            pass
+        # Быстрый путь: обычный RFC 2822 ('Mon, 1 Jan 2024 10:00:00 +0000')
+        if _RFC2822_RE.match(date_str):
+            try:
+                dt = parsedate_to_datetime(date_str)
+            except (TypeError, ValueError, IndexError):
+                dt = None
+            if dt is not None:
+                return dt if dt.tzinfo is not None else dt.replace(tzinfo=timezone.utc)
         
+        # Медленный путь: нестандартный формат
         if DATEUTIL_AVAILABLE:
             try:
                 dt = dateutil_parser.parse(date_str, fuzzy=True)
@@ -234,14 +531,20 @@ class GmailCleanerPro:
                 return dt
             except Exception:
                 pass
+        else:
+            try:
+                dt = parsedate_to_datetime(date_str)
+                if dt and dt.tzinfo is None:
+                    dt = dt.replace(tzinfo=timezone.utc)
+                return dt
+            except Exception:
+                pass
         
-        return datetime.min.replace(tzinfo=timezone.utc)
+        return _EPOCH_SENTINEL
 
     def clean_subject(self, subject: str) -> str:
         """Очистка темы письма от префиксов."""
-        cleaned = re.sub(r'^(re|fwd|fw|aw):\s*', '', subject, flags=re.IGNORECASE)
-        cleaned = re.sub(r'\s*[\(\[]\d+[\)\]]\s*$', '', cleaned)
-        return cleaned.strip().lower()
+        return _clean_subject(subject)
 
     # ==================== ПОИСК ПИСЕМ ====================
     
@@ -251,7 +554,7 @@ class GmailCleanerPro:
         parts = []
         
         if sender_email:
-            sender_email = sender_email.strip()
+            sender_email = self.extract_address(sender_email.strip())
             
             if self.validate_email(sender_email):
                 parts.append(f"from:{sender_email}")
@@ -302,151 +605,325 @@ class GmailCleanerPro:
             
         return query
 
+    def _parse_metadata_response(self, response: dict) -> Tuple[datetime, str, str]:
+        """Разбор ответа messages.get (format='metadata') в (дата, id, тема)."""
+        subject = None
+        date_str = None
+        
+        # Один проход по заголовкам; имена приходят в написании из самого письма
+        for header in response.get('payload', {}).get('headers', []):
+            name = header['name'].lower()
+            if name == 'subject' and subject is None:
+                subject = header['value']
+            elif name == 'date' and date_str is None:
+                date_str = header['value']
+        
+        if subject is None:
+            subject = "Без темы"
+        date_obj = self.parse_email_date(date_str)
+        
+        return (date_obj, response['id'], subject)
+
     def get_message_metadata_with_retry(self, msg_id: str) -> Optional[Tuple[datetime, str, str]]:
         """Получение метаданных письма с retry."""
         retry_count = 0
         
         while retry_count < self.config['max_retries']:
+            self._bucket.consume(GMAIL_QUOTA_UNITS['get'])
             try:
-                response = self.service.users().messages().get(
+                response = self._thread_service().users().messages().get(
                     userId='me', 
                     id=msg_id, 
                     format='metadata', 
-                    metadataHeaders=['Subject', 'Date', 'From']
+                    metadataHeaders=['Subject', 'Date'],
+                    fields='id,payload/headers(name,value)'
                 ).execute()
                 
-                headers = response.get('payload', {}).get('headers', [])
-                subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), "Без темы")
-                date_str = next((h['value'] for h in headers if h['name'].lower() == 'date'), None)
-                date_obj = self.parse_email_date(date_str)
-                
-                return (date_obj, response['id'], subject)
+                return self._parse_metadata_response(response)
                 
             except HttpError as e:
                 retry_count += 1
                 if e.resp.status in [429, 403, 500, 503]:
-                    backoff_time = self.exponential_backoff(retry_count)
-                    self.logger.warning(f"⏳ Rate limit. Ожидание {backoff_time:.1f}s...")
-                    time.sleep(backoff_time)
+                    backoff_time = self.exponential_backoff(retry_count, self.get_retry_after(e))
+                    self.logger.warning("⏳ Rate limit. Ожидание %.1fs...", backoff_time)
+                    self._bucket.penalize(backoff_time)
                 else:
-                    self.stats['errors'] += 1
-                    self.logger.error(f"❌ HTTP ошибка: {e}")
+                    self._add_errors(1)
+                    self.logger.error("❌ HTTP ошибка: %s", e)
                     return None
             except Exception as e:
-                self.stats['errors'] += 1
-                self.logger.error(f"❌ Ошибка получения метаданных: {e}")
+                self._add_errors(1)
+                self.logger.error("❌ Ошибка получения метаданных: %s", e)
                 return None
             
         return None
 
     def find_emails_by_criteria(self, query: str) -> List[Tuple[datetime, str, str]]:
         """Поиск писем по критериям."""
-        self.logger.info(f"🔍 Поиск писем: {query}")
+        self.logger.info("🔍 Поиск писем: %s", query)
         self.messages_cache.clear()
         
-        # Получаем все ID
-        all_message_ids = self._fetch_all_message_ids(query)
-        
-        if not all_message_ids:
-            self.logger.info("📭 Письма не найдены.")
-            return []
-        
-        self.logger.info(f"📊 Найдено {len(all_message_ids)} писем. Загрузка метаданных...")
-        
-        # Загружаем метаданные
+        # Метаданные загружаются batch-запросами (до 100 писем за один HTTP-запрос)
+        # параллельно с листанием страниц ID: пока запрашивается следующая
+        # страница, пачки с предыдущих уже в работе. Общее число писем
+        # известно только после последней страницы. У tqdm без total bool() бросает
+        # TypeError, поэтому наличие бара проверяем только через `is not None`.
         progress_bar = tqdm(
-            total=len(all_message_ids), 
+            total=None, 
             desc="Загрузка метаданных", 
             unit="писем"
         ) if TQDM_AVAILABLE else None
         
-        for msg_id in all_message_ids:
-            result = self.get_message_metadata_with_retry(msg_id)
-            if result:
-                self.messages_cache.append(result)
+        chunk_size = min(self.config['batch_size'], GMAIL_BATCH_LIMIT)
+        max_pending = self.config['fetch_workers'] * 2
+        total_ids = 0
+        chunk = []
+        pending = {}
+        
+        # Несколько batch-запросов в полёте одновременно, каждый поток со своим клиентом
+        submit = self._fetch_executor.submit
+        fetch_chunk = self._fetch_metadata_batch
+        
+        def dispatch(ids):
+            # Метаданные писем неизменны: из API грузим только то, чего нет в кэше
+            cached, missing = self._lookup_cached_metadata(ids)
+            self.messages_cache.extend(cached)
+            if progress_bar is not None and cached:
+                progress_bar.update(len(cached))
+            if missing:
+                pending[submit(fetch_chunk, missing)] = len(missing)
+        
+        def collect(done):
+            for future in done:
+                chunk_len = pending.pop(future)
+                results = future.result()
+                self.messages_cache.extend(results)
+                self._store_cached_metadata(results)
+                if progress_bar is not None:
+                    progress_bar.update(chunk_len)
+        
+        try:
+            for msg_id in self._iter_message_ids(query):
+                total_ids += 1
+                chunk.append(msg_id)
+                
+                if len(chunk) < chunk_size:
+                    continue
+                
+                dispatch(chunk)
+                chunk = []
+                
+                # Ограничиваем очередь, чтобы листание не убегало далеко вперёд
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
             
-            if progress_bar:
-                progress_bar.update(1)
+            if chunk:
+                dispatch(chunk)
             
-            time.sleep(self.config['delay_between_requests'])
+            if total_ids:
+                self.logger.info("📊 Найдено %d писем. Догрузка метаданных...", total_ids)
+                if progress_bar is not None:
+                    progress_bar.total = total_ids
+                    progress_bar.refresh()
+            
+            collect(as_completed(pending))
+        finally:
+            # Всё загруженное сохраняется одной транзакцией, даже если поиск прерван
+            self._meta_db.commit()
         
-        if progress_bar:
+        if progress_bar is not None:
             progress_bar.close()
         
-        # Фильтруем и сортируем
-        valid_messages = [
-            (dt, mid, subj) 
-            for dt, mid, subj in self.messages_cache 
-            if dt != datetime.min.replace(tzinfo=timezone.utc)
-        ]
-        valid_messages.sort(key=lambda x: x[0])
+        if not total_ids:
+            self.logger.info("📭 Письма не найдены.")
+            return []
         
-        self.messages_cache = valid_messages
+        # Фильтруем (письма без даты) и сортируем за один проход
+        self.messages_cache = sorted(
+            (m for m in self.messages_cache if m[0] is not _EPOCH_SENTINEL),
+            key=itemgetter(0)
+        )
         self.stats['found'] = len(self.messages_cache)
         
         return self.messages_cache
 
-    def _fetch_all_message_ids(self, query: str) -> List[str]:
-        """Получение всех ID писем по запросу."""
-        all_ids = []
-        page_token = None
+    def _fetch_metadata_batch(self, msg_ids: List[str]) -> List[Tuple[datetime, str, str]]:
+        """Загрузка метаданных пачки писем (до 100) одним batch-запросом."""
+        results = []
+        rate_limited = []
+        retry_afters = []
+        
+        def batch_callback(request_id, response, exception):
+            if exception is None:
+                results.append(self._parse_metadata_response(response))
+            elif isinstance(exception, HttpError) and exception.resp.status in [429, 403, 500, 503]:
+                # Откладываем письмо на повтор после завершения пачки
+                rate_limited.append(request_id)
+                retry_after = self.get_retry_after(exception)
+                if retry_after is not None:
+                    retry_afters.append(retry_after)
+            else:
+                self._add_errors(1)
+                self.logger.error("❌ Ошибка получения метаданных %s: %s", request_id, exception)
+        
+        service = self._thread_service()
+        # users().messages() каждый раз собирает новый Resource — строим один раз
+        get_message = service.users().messages().get
+        retry_count = 0
+        
+        while True:
+            batch = service.new_batch_http_request(callback=batch_callback)
+            add = batch.add
+            
+            for msg_id in msg_ids:
+                add(
+                    get_message(
+                        userId='me',
+                        id=msg_id,
+                        format='metadata',
+                        metadataHeaders=['Subject', 'Date'],
+                        fields='id,payload/headers(name,value)'
+                    ),
+                    request_id=msg_id
+                )
+            
+            self._bucket.consume(GMAIL_QUOTA_UNITS['get'] * len(msg_ids))
+            
+            try:
+                batch.execute()
+                break
+            except HttpError as e:
+                # Отказ всего batch-запроса (до колбэков): повторяем пачку целиком
+                retry_count += 1
+                if e.resp.status in [429, 403, 500, 503] and retry_count < self.config['max_retries']:
+                    backoff_time = self.exponential_backoff(retry_count, self.get_retry_after(e))
+                    self.logger.warning(
+                        "⏳ Batch отклонён (%s). Повтор через %.1fs...", e.resp.status, backoff_time
+                    )
+                    self._bucket.penalize(backoff_time)
+                    continue
+                self._add_errors(len(msg_ids))
+                self.logger.error("❌ Ошибка batch загрузки метаданных: %s", e)
+                return results
+            except Exception as e:
+                self._add_errors(len(msg_ids))
+                self.logger.error("❌ Ошибка batch загрузки метаданных: %s", e)
+                return results
+        
+        if rate_limited:
+            backoff_time = self.exponential_backoff(1, max(retry_afters, default=None))
+            self.logger.warning(
+                "⏳ Rate limit для %d писем. Повтор через %.1fs...", len(rate_limited), backoff_time
+            )
+            self._bucket.penalize(backoff_time)
+            
+            for msg_id in rate_limited:
+                result = self.get_message_metadata_with_retry(msg_id)
+                if result:
+                    results.append(result)
+        
+        return results
+
+    def _add_errors(self, count: int):
+        """Потокобезопасное увеличение счётчика ошибок."""
+        with self._lock:
+            self.stats['errors'] += count
+
+    def _list_messages_page(self, query: str, page_token: Optional[str]) -> dict:
+        """Запрос одной страницы messages.list с retry при rate limit."""
+        retry_count = 0
         
         while True:
+            self._bucket.consume(GMAIL_QUOTA_UNITS['list'])
             try:
-                response = self.service.users().messages().list(
+                return self._thread_service().users().messages().list(
                     userId='me',
                     q=f"{query} in:anywhere -in:trash",
-                    maxResults=self.config['batch_size'],
+                    maxResults=self.config['list_page_size'],
                     pageToken=page_token
                 ).execute()
-                
-                messages = response.get('messages', [])
-                if not messages:
-                    break
-                
-                all_ids.extend([msg['id'] for msg in messages])
-                page_token = response.get('nextPageToken')
-                
-                if not page_token:
-                    break
-                
-                time.sleep(self.config['sleep_after_list'])
-                
             except HttpError as e:
-                self.logger.error(f"❌ Ошибка при получении списка: {e}")
-                break
+                retry_count += 1
+                if e.resp.status not in [429, 403, 500, 503] or retry_count >= self.config['max_retries']:
+                    raise
+                backoff_time = self.exponential_backoff(retry_count, self.get_retry_after(e))
+                self.logger.warning("⏳ Rate limit при получении списка. Ожидание %.1fs...", backoff_time)
+                self._bucket.penalize(backoff_time)
+
+    # ==================== КЭШ МЕТАДАННЫХ ====================
+
+    def _open_metadata_cache(self) -> sqlite3.Connection:
+        """Открытие sqlite-кэша метаданных писем (ID письма в Gmail неизменен) и ссылок отписки."""
+        os.makedirs(self.config['stats_dir'], exist_ok=True)
+        conn = sqlite3.connect(os.path.join(self.config['stats_dir'], 'metadata_cache.db'))
+        conn.execute("CREATE TABLE IF NOT EXISTS meta(id TEXT PRIMARY KEY, date TEXT, subject TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS unsub(sender TEXT PRIMARY KEY, url TEXT, ts INTEGER)")
+        conn.commit()
+        return conn
+
+    def _lookup_cached_metadata(self, msg_ids: List[str]) -> Tuple[List[Tuple[datetime, str, str]], List[str]]:
+        """Разделение ID на найденные в кэше (с метаданными) и отсутствующие."""
+        placeholders = ",".join("?" * len(msg_ids))
+        rows = self._meta_db.execute(
+            f"SELECT id, date, subject FROM meta WHERE id IN ({placeholders})", msg_ids
+        ).fetchall()
+        
+        # Пустая дата в кэше — письмо без разбираемой даты
+        cached = [
+            (datetime.fromisoformat(date) if date else _EPOCH_SENTINEL, mid, subject)
+            for mid, date, subject in rows
+        ]
+        found = {mid for mid, _, _ in rows}
+        missing = [mid for mid in msg_ids if mid not in found]
+        return cached, missing
+
+    def _store_cached_metadata(self, messages: List[Tuple[datetime, str, str]]):
+        """Запись метаданных в кэш (фиксируется в конце поиска)."""
+        self._meta_db.executemany(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?, ?)",
+            [(mid, '' if dt is _EPOCH_SENTINEL else dt.isoformat(), subj) for dt, mid, subj in messages]
+        )
+
+    def _iter_message_ids(self, query: str) -> Generator[str, None, None]:
+        """Постраничная выдача ID писем по запросу.
+        
+        Следующая страница запрашивается в фоне, пока вызывающий код
+        обрабатывает текущую.
+        """
+        future = self._list_executor.submit(self._list_messages_page, query, None)
         
-        return all_ids
+        while future is not None:
+            try:
+                response = future.result()
+            except HttpError as e:
+                self.logger.error("❌ Ошибка при получении списка: %s", e)
+                break
+            
+            messages = response.get('messages', [])
+            if not messages:
+                break
+            
+            page_token = response.get('nextPageToken')
+            future = self._list_executor.submit(
+                self._list_messages_page, query, page_token
+            ) if page_token else None
+            
+            yield from (msg['id'] for msg in messages)
 
     # ==================== КЛАСТЕРИЗАЦИЯ ====================
     
     def group_by_similar_subjects(self, messages: List[Tuple[datetime, str, str]]) -> List[Tuple[datetime, str, str]]:
         """Группировка писем по похожим темам."""
-        if not FUZZYWUZZY_AVAILABLE:
-            self.logger.warning("⚠️ fuzzywuzzy не установлен. Пропуск кластеризации.")
-            return messages
-        
         threshold = self.config['subject_similarity_threshold']
-        processed = [(self.clean_subject(subj), dt, mid, subj) for dt, mid, subj in messages]
-        
-        clusters = []
-        unclustered = list(processed)
         
-        while unclustered:
-            ref_clean, ref_dt, ref_mid, ref_subj = unclustered.pop(0)
-            current_cluster = [(ref_dt, ref_mid, ref_subj)]
-            
-            to_remove = []
-            for item in unclustered:
-                test_clean, test_dt, test_mid, test_subj = item
-                if fuzz.ratio(ref_clean, test_clean) >= threshold:
-                    current_cluster.append((test_dt, test_mid, test_subj))
-                    to_remove.append(item)
-            
-            for item in to_remove:
-                unclustered.remove(item)
-            
-            clusters.append(current_cluster)
+        if RAPIDFUZZ_AVAILABLE:
+            clusters = self._cluster_subjects_rapidfuzz(messages, threshold)
+        elif FUZZYWUZZY_AVAILABLE:
+            clusters = self._cluster_subjects_fuzzywuzzy(messages, threshold)
+        else:
+            self.logger.warning("⚠️ rapidfuzz/fuzzywuzzy не установлены. Пропуск кластеризации.")
+            return messages
         
         # Сортировка кластеров по размеру
         clusters.sort(key=len, reverse=True)
@@ -454,77 +931,222 @@ class GmailCleanerPro:
         # Объединение кластеров в один список
         reordered = []
         for cluster in clusters:
-            cluster.sort(key=lambda x: x[0])
+            cluster.sort(key=itemgetter(0))
             reordered.extend(cluster)
         
         return reordered
 
+    def _cluster_subjects_rapidfuzz(self, messages: List[Tuple[datetime, str, str]],
+                                    threshold: int) -> List[List[Tuple[datetime, str, str]]]:
+        """Кластеризация тем через rapidfuzz.process.cdist и компоненты связности графа похожих пар."""
+        if not messages:
+            return []
+        
+        cleaned = [self.clean_subject(subj) for _, _, subj in messages]
+        
+        # Одинаковые темы сравниваем один раз
+        unique = list(dict.fromkeys(cleaned))
+        index = {subj: i for i, subj in enumerate(unique)}
+        pair_rows = []
+        pair_cols = []
+        
+        # score_cutoff обнуляет непохожие пары прямо в C++; матрица считается
+        # блоками строк, чтобы не держать в памяти n×n целиком. cutoff сравнивается
+        # с дробной оценкой до округления, поэтому берём его на 0.5 ниже, а порог
+        # применяем к округлённой — как fuzzywuzzy (ratio 84.6 при пороге 85 проходит)
+        for start in range(0, len(unique), SIMILARITY_BLOCK_ROWS):
+            scores = rf_process.cdist(
+                unique[start:start + SIMILARITY_BLOCK_ROWS],
+                unique,
+                scorer=rf_fuzz.ratio,
+                score_cutoff=max(0, min(100, threshold - 0.5)),
+                dtype=np.uint8,
+                workers=-1
+            )
+            rows, cols = np.nonzero(scores >= threshold)
+            rows += start
+            # Матрица симметрична: достаточно пар над диагональю
+            upper = cols > rows
+            pair_rows.append(rows[upper].astype(np.int32))
+            pair_cols.append(cols[upper].astype(np.int32))
+        
+        rows = np.concatenate(pair_rows)
+        cols = np.concatenate(pair_cols)
+        
+        if SCIPY_AVAILABLE:
+            graph = coo_matrix((np.ones(len(rows), dtype=np.bool_), (rows, cols)), shape=(len(unique), len(unique)))
+            _, labels = connected_components(graph, directed=False)
+        else:
+            parent = list(range(len(unique)))
+            
+            def find(i):
+                while parent[i] != i:
+                    parent[i] = parent[parent[i]]
+                    i = parent[i]
+                return i
+            
+            for row, col in zip(rows.tolist(), cols.tolist()):
+                root_a, root_b = find(row), find(col)
+                if root_a != root_b:
+                    parent[root_b] = root_a
+            labels = [find(i) for i in range(len(unique))]
+        
+        clusters = {}
+        for item, subj in zip(messages, cleaned):
+            clusters.setdefault(labels[index[subj]], []).append(item)
+        
+        return list(clusters.values())
+
+    def _cluster_subjects_fuzzywuzzy(self, messages: List[Tuple[datetime, str, str]],
+                                     threshold: int) -> List[List[Tuple[datetime, str, str]]]:
+        """Кластеризация тем попарным сравнением fuzzywuzzy (запасной вариант)."""
+        cleaned = [self.clean_subject(subj) for _, _, subj in messages]
+        lengths = [len(subj) for subj in cleaned]
+        n = len(messages)
+        # Отметки вместо pop(0)/remove: список не перестраивается на каждом шаге
+        claimed = bytearray(n)
+        
+        clusters = []
+        
+        for i in range(n):
+            if claimed[i]:
+                continue
+            claimed[i] = 1
+            ref_clean = cleaned[i]
+            ref_len = lengths[i]
+            current_cluster = [messages[i]]
+            
+            for j in range(i + 1, n):
+                if claimed[j]:
+                    continue
+                
+                # fuzz.ratio не превышает 200·min(a, b)/(a + b): заведомо далёкие по длине пропускаем
+                total_len = ref_len + lengths[j]
+                if total_len and round(200 * min(ref_len, lengths[j]) / total_len) < threshold:
+                    continue
+                
+                if fuzz.ratio(ref_clean, cleaned[j]) >= threshold:
+                    claimed[j] = 1
+                    current_cluster.append(messages[j])
+            
+            clusters.append(current_cluster)
+        
+        return clusters
+
     # ==================== BACKUP ====================
     
-    def export_emails_before_delete(self, messages_info: List[Tuple[datetime, str, str]]) -> Optional[str]:
-        """Экспорт писем в JSON перед удалением."""
+    def export_emails_before_delete(
+        self, messages_info: List[Tuple[datetime, str, str]]
+    ) -> Tuple[Optional[str], List[Tuple[datetime, str, str]]]:
+        """Экспорт писем в JSONL (gzip) перед удалением.
+        
+        Письма загружаются batch-запросами и пишутся в файл по одному
+        на строку сразу по мере получения, не накапливаясь в памяти.
+        Возвращает (файл backup, письма, которые в него не попали).
+        """
         if not messages_info or not self.config['auto_backup']:
-            return None
+            return None, []
         
         os.makedirs(self.config['backup_dir'], exist_ok=True)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_file = os.path.join(self.config['backup_dir'], f'backup_{timestamp}.json')
+        backup_file = os.path.join(self.config['backup_dir'], f'backup_{timestamp}.jsonl.gz')
         
-        self.logger.info(f"💾 Создание backup: {backup_file}")
+        self.logger.info("💾 Создание backup: %s", backup_file)
         
-        backup_data = []
         progress_bar = tqdm(
-            messages_info, 
+            total=len(messages_info), 
             desc="Backup", 
             unit="писем"
-        ) if TQDM_AVAILABLE else messages_info
+        ) if TQDM_AVAILABLE else None
         
-        for dt, msg_id, subj in progress_bar:
-            try:
-                msg = self.service.users().messages().get(
-                    userId='me', 
-                    id=msg_id, 
-                    format='full'
-                ).execute()
-                backup_data.append({
-                    'id': msg_id,
-                    'date': dt.isoformat(),
-                    'subject': subj,
-                    'full_data': msg
-                })
-                self.stats['backed_up'] += 1
-            except Exception as e:
-                self.logger.error(f"❌ Ошибка backup для {msg_id}: {e}")
+        info_by_id = {msg_id: (dt, subj) for dt, msg_id, subj in messages_info}
+        chunk_size = min(self.config['batch_size'], GMAIL_BATCH_LIMIT)
+        get_message = self.service.users().messages().get
+        backed_up_ids = set()
+        rate_limited = []
+        
+        with gzip.open(backup_file, 'wt', encoding='utf-8', compresslevel=3) as f:
+            
+            def batch_callback(request_id, response, exception):
+                if exception is None:
+                    dt, subj = info_by_id[request_id]
+                    f.write(json.dumps({
+                        'id': request_id,
+                        'date': dt.isoformat(),
+                        'subject': subj,
+                        'full_data': response
+                    }, ensure_ascii=False, separators=(',', ':')) + '\n')
+                    backed_up_ids.add(request_id)
+                elif isinstance(exception, HttpError) and exception.resp.status in [429, 403, 500, 503]:
+                    rate_limited.append(request_id)
+                else:
+                    self.logger.error("❌ Ошибка backup для %s: %s", request_id, exception)
+            
+            for i in range(0, len(messages_info), chunk_size):
+                pending_ids = [msg_id for _, msg_id, _ in messages_info[i:i + chunk_size]]
+                retry_count = 0
+                
+                # Письма, упёршиеся в rate limit, досылаем следующим batch-запросом
+                while pending_ids:
+                    rate_limited.clear()
+                    batch = self.service.new_batch_http_request(callback=batch_callback)
+                    for msg_id in pending_ids:
+                        batch.add(get_message(userId='me', id=msg_id, format='full'), request_id=msg_id)
+                    
+                    self._bucket.consume(GMAIL_QUOTA_UNITS['get'] * len(pending_ids))
+                    try:
+                        batch.execute()
+                    except HttpError as e:
+                        # Отказ всего batch-запроса: повторяем ещё не сохранённые письма пачки
+                        retry_count += 1
+                        if e.resp.status in [429, 403, 500, 503] and retry_count < self.config['max_retries']:
+                            backoff_time = self.exponential_backoff(retry_count, self.get_retry_after(e))
+                            self.logger.warning(
+                                "⏳ Batch backup отклонён (%s). Повтор через %.1fs...", e.resp.status, backoff_time
+                            )
+                            self._bucket.penalize(backoff_time)
+                            pending_ids = [msg_id for msg_id in pending_ids if msg_id not in backed_up_ids]
+                            continue
+                        self.logger.error("❌ Ошибка batch backup: %s", e)
+                        break
+                    except Exception as e:
+                        self.logger.error("❌ Ошибка batch backup: %s", e)
+                        break
+                    
+                    pending_ids = list(rate_limited)
+                    retry_count += 1
+                    if pending_ids:
+                        if retry_count >= self.config['max_retries']:
+                            self.logger.error("❌ Backup не удался для %d писем (rate limit)", len(pending_ids))
+                            break
+                        self._bucket.penalize(self.exponential_backoff(retry_count))
+                
+                if progress_bar:
+                    progress_bar.update(min(chunk_size, len(messages_info) - i))
         
-        if TQDM_AVAILABLE:
+        if progress_bar:
             progress_bar.close()
         
-        with open(backup_file, 'w', encoding='utf-8') as f:
-            json.dump(backup_data, f, ensure_ascii=False, indent=2)
+        written = len(backed_up_ids)
+        self.stats['backed_up'] += written
+        self.logger.info("✅ Backup сохранен: %s (%d писем)", backup_file, written)
         
-        self.logger.info(f"✅ Backup сохранен: {backup_file} ({len(backup_data)} писем)")
-        return backup_file
+        not_backed_up = [m for m in messages_info if m[1] not in backed_up_ids]
+        if not_backed_up:
+            self.logger.warning("⚠️ Не попали в backup: %d писем", len(not_backed_up))
+        return backup_file, not_backed_up
 
     # ==================== УДАЛЕНИЕ ====================
     
     def trash_emails_batch(self, messages_info: List[Tuple[datetime, str, str]]):
-        """Массовое удаление писем батчами (быстрее в 10 раз!)."""
+        """Массовое перемещение писем в корзину через batchModify (до 1000 писем за запрос)."""
         if not messages_info:
             return
         
         total = len(messages_info)
-        batch_size = self.config['batch_delete_size']
+        batch_size = min(self.config['batch_delete_size'], GMAIL_BATCH_MODIFY_LIMIT)
         
-        self.logger.info(f"🗑️ Перемещение {total} писем в корзину (batch режим)...")
-        
-        def batch_callback(request_id, response, exception):
-            if exception:
-                self.stats['errors'] += 1
-                self.logger.error(f"❌ Ошибка: {exception}")
-            else:
-                # В батче нет ответа, который бы сказал, сколько успешно удалено. 
-                # Считаем, что все письма в запросе успешны, если нет общей ошибки
-                pass
+        self.logger.info("🗑️ Перемещение %d писем в корзину (batch режим)...", total)
         
         trashed_count_in_batch = 0
         
@@ -534,29 +1156,43 @@ class GmailCleanerPro:
             unit="писем"
         ) if TQDM_AVAILABLE else None
 
+        batch_modify = self.service.users().messages().batchModify
+
         for i in range(0, total, batch_size):
-            chunk = messages_info[i:i + batch_size]
-            batch = self.service.new_batch_http_request(callback=batch_callback)
+            chunk_ids = [msg_id for _, msg_id, _ in messages_info[i:i + batch_size]]
+            retry_count = 0
             
-            for dt, msg_id, subj in chunk:
-                batch.add(
-                    self.service.users().messages().trash(userId='me', id=msg_id)
-                )
-                
-            try:
-                batch.execute()
-                trashed_count_in_batch += len(chunk)
-                if progress_bar:
-                    progress_bar.update(len(chunk))
-                time.sleep(self.config['delay_between_requests'])
-            except Exception as e:
-                self.logger.error(f"❌ Ошибка batch операции: {e}")
+            # Один запрос на всю пачку: метка TRASH ставится на стороне сервера.
+            # Ответ пустой, поэтому ошибка (если есть) относится ко всей пачке.
+            while True:
+                self._bucket.consume(GMAIL_QUOTA_UNITS['batch_modify'])
+                try:
+                    batch_modify(
+                        userId='me',
+                        body={'ids': chunk_ids, 'addLabelIds': ['TRASH']}
+                    ).execute()
+                    trashed_count_in_batch += len(chunk_ids)
+                    if progress_bar:
+                        progress_bar.update(len(chunk_ids))
+                    break
+                except HttpError as e:
+                    retry_count += 1
+                    if e.resp.status in [429, 403, 500, 503] and retry_count < self.config['max_retries']:
+                        self._bucket.penalize(self.exponential_backoff(retry_count, self.get_retry_after(e)))
+                        continue
+                    self.stats['errors'] += len(chunk_ids)
+                    self.logger.error("❌ Ошибка batch операции: %s", e)
+                    break
+                except Exception as e:
+                    self.stats['errors'] += len(chunk_ids)
+                    self.logger.error("❌ Ошибка batch операции: %s", e)
+                    break
                 
         if progress_bar:
             progress_bar.close()
 
         self.stats['trashed'] += trashed_count_in_batch
-        self.logger.info(f"✅ Batch завершен. Перемещено: {trashed_count_in_batch}")
+        self.logger.info("✅ Batch завершен. Перемещено: %d", trashed_count_in_batch)
 
 
     def trash_emails_interactive(self, messages_info: List[Tuple[datetime, str, str]]):
@@ -610,9 +1246,15 @@ class GmailCleanerPro:
             print(f"📝 Будет удалено: {len(messages_to_delete)}, оставлено: {skipped_count}")
         
         elif action == 'b':
-            # Создать backup и удалить
-            self.export_emails_before_delete(messages_info)
-            messages_to_delete = messages_info
+            # Создать backup и удалить только те письма, что в него попали
+            _, not_backed_up = self.export_emails_before_delete(messages_info)
+            if not_backed_up:
+                failed_ids = {msg_id for _, msg_id, _ in not_backed_up}
+                messages_to_delete = [m for m in messages_info if m[1] not in failed_ids]
+                skipped_count = len(not_backed_up)
+                print(f"⚠️ {skipped_count} писем не попали в backup и не будут удалены.")
+            else:
+                messages_to_delete = messages_info
         
         else:
             print("❌ Операция отменена.")
@@ -633,7 +1275,6 @@ class GmailCleanerPro:
             
             for dt, msg_id, subj in progress_bar:
                 self.trash_single_message_with_retry(msg_id)
-                time.sleep(self.config['delay_between_requests'])
             
             if TQDM_AVAILABLE:
                 progress_bar.close()
@@ -651,6 +1292,7 @@ class GmailCleanerPro:
         retry_count = 0
         
         while retry_count < self.config['max_retries']:
+            self._bucket.consume(GMAIL_QUOTA_UNITS['trash'])
             try:
                 self.service.users().messages().trash(userId='me', id=msg_id).execute()
                 self.stats['trashed'] += 1
@@ -658,8 +1300,8 @@ class GmailCleanerPro:
             except HttpError as e:
                 retry_count += 1
                 if e.resp.status in [429, 403]:
-                    backoff_time = self.exponential_backoff(retry_count)
-                    time.sleep(backoff_time)
+                    backoff_time = self.exponential_backoff(retry_count, self.get_retry_after(e))
+                    self._bucket.penalize(backoff_time)
                 else:
                     self.stats['errors'] += 1
                     return False
@@ -671,8 +1313,36 @@ class GmailCleanerPro:
 
     # ==================== ОТПИСКА ОТ РАССЫЛОК ====================
     
-    def find_unsubscribe_link(self, msg_id: str) -> Optional[str]:
-        """Поиск ссылки для отписки в письме."""
+    def _get_cached_unsubscribe_link(self, sender: str) -> Optional[str]:
+        """Ссылка отписки из кэша, если она найдена не раньше unsubscribe_cache_days назад."""
+        min_ts = int(time.time()) - self.config['unsubscribe_cache_days'] * 86400
+        row = self._meta_db.execute(
+            "SELECT url FROM unsub WHERE sender = ? AND ts > ?", (sender.lower(), min_ts)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _store_unsubscribe_link(self, sender: str, url: str):
+        """Сохранение найденной ссылки отписки для отправителя."""
+        self._meta_db.execute(
+            "INSERT OR REPLACE INTO unsub VALUES (?, ?, ?)", (sender.lower(), url, int(time.time()))
+        )
+        self._meta_db.commit()
+
+    def find_unsubscribe_link(self, msg_id: str, sender: Optional[str] = None) -> Optional[str]:
+        """Поиск ссылки для отписки в письме (с кэшем по отправителю, если он указан)."""
+        if sender:
+            cached_url = self._get_cached_unsubscribe_link(sender)
+            if cached_url:
+                return cached_url
+        
+        url = self._find_unsubscribe_link_in_message(msg_id)
+        if url and sender:
+            self._store_unsubscribe_link(sender, url)
+        return url
+
+    def _find_unsubscribe_link_in_message(self, msg_id: str) -> Optional[str]:
+        """Поиск ссылки для отписки в заголовках и теле письма."""
+        self._bucket.consume(GMAIL_QUOTA_UNITS['get'])
         try:
             msg = self.service.users().messages().get(
                 userId='me', 
@@ -685,21 +1355,22 @@ class GmailCleanerPro:
             for h in headers:
                 if h.get('name', '').lower() == 'list-unsubscribe':
                     link = h['value']
+                    # Часто там только mailto: — тогда regex не нужен
+                    if '<http' not in link:
+                        continue
                     # Ищем HTTP/HTTPS ссылку в угловых скобках
-                    match = re.search(r'<(https?://[^>]+)>', link)
+                    match = _UNSUB_HEADER_RE.search(link)
                     if match:
                         return match.group(1)
             
             # Ищем в теле письма
             body = self._get_email_body(msg)
-            patterns = [
-                r'(https?://[^\s]+unsubscribe[^\s"<>]*)',
-                r'(https?://[^\s]+opt-out[^\s"<>]*)',
-                r'(https?://[^\s]+remove[^\s"<>]*)',
-            ]
-            
-            for pattern in patterns:
-                match = re.search(pattern, body, re.IGNORECASE)
+            body_lower = body.lower()
+            
+            for keyword, pattern in _UNSUB_BODY_RES:
+                if keyword not in body_lower:
+                    continue
+                match = pattern.search(body)
                 if match:
                     url = match.group(1).rstrip('.,;)')
                     return url
@@ -710,7 +1381,7 @@ class GmailCleanerPro:
         return None
 
     def _get_email_body(self, msg: dict) -> str:
-        """Извлечение текста из тела письма."""
+        """Извлечение текста из тела письма (text/plain, а при его отсутствии text/html)."""
         
         def decode_part(part):
             body_data = part.get('body', {}).get('data', '')
@@ -724,44 +1395,63 @@ class GmailCleanerPro:
         if 'body' in payload and payload['body'].get('data'):
             return decode_part(payload)
         
-        # Multipart
-        if 'parts' in payload:
-            text = ''
-            for part in payload['parts']:
-                if part.get('mimeType') == 'text/plain':
-                    text += decode_part(part)
-                elif part.get('mimeType') == 'text/html':
-                    text += decode_part(part)
-            return text
+        # Multipart, включая вложенные multipart/alternative и multipart/related
+        plain_parts = []
+        html_parts = []
+        
+        def walk(parts):
+            for part in parts:
+                mime_type = part.get('mimeType', '')
+                if mime_type == 'text/plain':
+                    plain_parts.append(part)
+                elif mime_type == 'text/html':
+                    html_parts.append(part)
+                elif mime_type.startswith('multipart/'):
+                    walk(part.get('parts', []))
         
-        return ''
+        walk(payload.get('parts', []))
+        
+        # Декодируем только выбранный вариант: HTML-копию того же текста не трогаем
+        return ''.join(decode_part(part) for part in (plain_parts or html_parts))
 
     def interactive_unsubscribe(self, sender_email: str):
         """Интерактивная отписка от рассылки."""
-        print(f"\n📧 Поиск писем от {sender_email}...")
-        
-        query = f"from:{sender_email}"
-        messages = self.find_emails_by_criteria(query)
-        
-        if not messages:
-            print(f"❌ Письма от {sender_email} не найдены.")
-            return
-        
-        # Берем последнее письмо
-        latest = messages[-1]
-        dt, msg_id, subject = latest
-        
-        print(f"\n📬 Последнее письмо:")
-        print(f"    Тема: {subject}")
-        print(f"    Дата: {dt.astimezone().strftime('%Y-%m-%d %H:%M:%S')}")
+        # Как и при чистке, принимаем и вставленный заголовок '"Имя" <user@host>'
+        sender_email = self.extract_address(sender_email.strip())
         
-        print("\n🔍 Поиск ссылки для отписки...")
-        unsubscribe_link = self.find_unsubscribe_link(msg_id)
+        # Ссылка отписки стабильна для отправителя: сначала смотрим кэш
+        unsubscribe_link = self._get_cached_unsubscribe_link(sender_email)
         
-        if not unsubscribe_link:
-            print("⚠️ Ссылка для отписки не найдена.")
-            print("     Попробуйте отписаться вручную из письма.")
-            return
+        if unsubscribe_link:
+            print(f"\n💾 Ссылка для {sender_email} взята из кэша.")
+        else:
+            print(f"\n📧 Поиск писем от {sender_email}...")
+            
+            query = f"from:{sender_email}"
+            messages = self.find_emails_by_criteria(query)
+            
+            if not messages:
+                print(f"❌ Письма от {sender_email} не найдены.")
+                return
+            
+            # Берем последнее письмо
+            latest = messages[-1]
+            dt, msg_id, subject = latest
+            
+            print(f"\n📬 Последнее письмо:")
+            print(f"    Тема: {subject}")
+            print(f"    Дата: {dt.astimezone().strftime('%Y-%m-%d %H:%M:%S')}")
+            
+            print("\n🔍 Поиск ссылки для отписки...")
+            # Кэш уже проверен выше — ищем в письме напрямую
+            unsubscribe_link = self._find_unsubscribe_link_in_message(msg_id)
+            
+            if not unsubscribe_link:
+                print("⚠️ Ссылка для отписки не найдена.")
+                print("     Попробуйте отписаться вручную из письма.")
+                return
+            
+            self._store_unsubscribe_link(sender_email, unsubscribe_link)
         
         print(f"\n✅ Найдена ссылка:")
         print(f"    {unsubscribe_link}\n")
@@ -814,77 +1504,182 @@ class GmailCleanerPro:
 
     # ==================== СТАТИСТИКА ====================
     
-    def load_sender_counts(self, filename: str = 'sender_counts.csv') -> Optional['pd.DataFrame']:
-        """Загрузка статистики отправителей из CSV."""
+    def load_sender_counts(self, filename: str = 'sender_counts.csv',
+                           top_k: Optional[int] = None) -> Optional['pd.DataFrame']:
+        """Загрузка топ-K отправителей (по числу писем) из CSV."""
         if not PANDAS_AVAILABLE:
             return None
         
-        if not os.path.exists(filename):
+        try:
+            csv_stat = os.stat(filename)
+        except OSError:
             return None
         
         try:
-            df = pd.read_csv(filename)
-            
-            if 'sender_email' not in df.columns or 'message_count' not in df.columns:
-                self.logger.error("❌ CSV должен содержать 'sender_email' и 'message_count'")
-                return None
-            
-            df['message_count'] = pd.to_numeric(df['message_count'], errors='coerce').fillna(0).astype(int)
-            df = df.sort_values('message_count', ascending=False).reset_index(drop=True)
-            
-            self.logger.info(f"✅ Загружена статистика: {len(df)} отправителей")
-            return df
-        
+            df, total = _load_top_senders(
+                os.path.abspath(filename),
+                csv_stat.st_mtime_ns,
+                csv_stat.st_size,
+                top_k or self.config['top_senders_count']
+            )
+        except ValueError as e:
+            # Нет нужной колонки или message_count не целое число
+            self.logger.error(f"❌ CSV должен содержать 'sender_email' и целочисленный 'message_count': {e}")
+            return None
         except Exception as e:
             self.logger.error(f"❌ Ошибка чтения CSV: {e}")
             return None
+        
+        self.logger.info(f"✅ Загружена статистика: {total} отправителей")
+        # Копия: закэшированная таблица не должна меняться снаружи
+        return df.copy()
 
     def save_stats(self):
-        """Сохранение статистики работы."""
-        os.makedirs(self.config['stats_dir'], exist_ok=True)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        stats_file = os.path.join(self.config['stats_dir'], f'stats_{timestamp}.json')
+        """Сохранение статистики работы (stats_dir создаётся в __init__ вместе с кэшем метаданных)."""
+        now = datetime.now()
+        stats_file = os.path.join(self.config['stats_dir'], f"stats_{now.strftime('%Y%m%d_%H%M%S')}.json")
         
         detailed_stats = {
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': now.isoformat(),
             'summary': self.stats,
             'config': self.config,
             'dry_run': self.config['dry_run']
         }
         
-        with open(stats_file, 'w', encoding='utf-8') as f:
-            json.dump(detailed_stats, f, indent=2, ensure_ascii=False)
+        # Отступы нужны только для чтения глазами; без них stdlib json работает через C-энкодер
+        pretty = self.config.get('stats_pretty', False)
+        
+        if ORJSON_AVAILABLE:
+            data = orjson.dumps(detailed_stats, option=orjson.OPT_INDENT_2 if pretty else None)
+        else:
+            # ensure_ascii по умолчанию: в статистике ASCII, а не-ASCII (пути в конфиге) экранируется без потерь
+            data = json.dumps(detailed_stats, indent=2 if pretty else None).encode('utf-8')
+        
+        # Пишем во временный файл рядом и атомарно переименовываем: при сбое не остаётся обрывка
+        fd, tmp_file = tempfile.mkstemp(dir=self.config['stats_dir'], suffix='.json.tmp')
+        try:
+            try:
+                f = os.fdopen(fd, 'wb')
+            except BaseException:
+                os.close(fd)
+                raise
+            with f:
+                f.write(data)
+            os.chmod(tmp_file, 0o666 & ~_UMASK)
+            os.replace(tmp_file, stats_file)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
         
         self.logger.info(f"📊 Статистика сохранена: {stats_file}")
 
     def display_stats(self):
-        """Вывод финальной статистики."""
-        print("\n" + "="*50)
-        print("📊 СТАТИСТИКА РАБОТЫ")
-        print("="*50)
-        print(f"🔍 Найдено писем:     {self.stats['found']}")
-        print(f"🗑️ Удалено:            {self.stats['trashed']}")
-        print(f"⏭️ Пропущено:          {self.stats['skipped']}")
-        print(f"💾 Backup создан:      {self.stats['backed_up']}")
-        print(f"❌ Ошибок:             {self.stats['errors']}")
-        print("="*50)
+        """Вывод финальной статистики (одной записью в stdout)."""
+        sys.stdout.write("\n" + "\n".join([
+            _STATS_RULE,
+            "📊 СТАТИСТИКА РАБОТЫ",
+            _STATS_RULE,
+            f"🔍 Найдено писем:     {self.stats['found']}",
+            f"🗑️ Удалено:            {self.stats['trashed']}",
+            f"⏭️ Пропущено:          {self.stats['skipped']}",
+            f"💾 Backup создан:      {self.stats['backed_up']}",
+            f"❌ Ошибок:             {self.stats['errors']}",
+            _STATS_RULE,
+        ]) + "\n")
 
 
 # ==================== CLI ====================
 
-def parse_arguments():
-    """Парсинг аргументов командной строки."""
-    parser = argparse.ArgumentParser(
-        description='Gmail Cleaner Pro - Профессиональный инструмент управления почтой'
+_CLI_USAGE = (
+    "usage: {prog} [-h] [--sender SENDER] [--days DAYS] [--dry-run]\n"
+    "       {pad} [--batch-size BATCH_SIZE] [--no-backup] [--unsubscribe UNSUBSCRIBE]"
+)
+
+_CLI_HELP = """
+Gmail Cleaner Pro - Профессиональный инструмент управления почтой
+
+options:
+  -h, --help            show this help message and exit
+  --sender SENDER       Email отправителя
+  --days DAYS           Письма старше N дней
+  --dry-run             Режим без удаления
+  --batch-size BATCH_SIZE
+                        Размер батча
+  --no-backup           Отключить auto-backup
+  --unsubscribe UNSUBSCRIBE
+                        Отписаться от рассылки (email)"""
+
+# Флаг -> (атрибут, тип значения); тип None — флаг без значения
+_CLI_OPTIONS = {
+    '--sender': ('sender', str),
+    '--days': ('days', int),
+    '--dry-run': ('dry_run', None),
+    '--batch-size': ('batch_size', int),
+    '--no-backup': ('no_backup', None),
+    '--unsubscribe': ('unsubscribe', str),
+}
+
+
+def _cli_error(prog: str, message: str):
+    """Ошибка разбора аргументов в формате argparse (usage + сообщение, код выхода 2)."""
+    print(_CLI_USAGE.format(prog=prog, pad=' ' * len(prog)), file=sys.stderr)
+    print(f"{prog}: error: {message}", file=sys.stderr)
+    sys.exit(2)
+
+
+def _resolve_cli_flag(prog: str, flag: str) -> str:
+    """Полное имя флага по уникальному префиксу (как в argparse: --dry → --dry-run)."""
+    if flag in _CLI_OPTIONS or not flag.startswith('--') or flag == '--':
+        return flag
+    matches = [name for name in (*_CLI_OPTIONS, '--help') if name.startswith(flag)]
+    if len(matches) > 1:
+        _cli_error(prog, f"ambiguous option: {flag} could match {', '.join(matches)}")
+    return matches[0] if matches else flag
+
+
+def parse_arguments() -> SimpleNamespace:
+    """Парсинг аргументов командной строки (флагов немного — argparse не нужен)."""
+    prog = os.path.basename(sys.argv[0])
+    args = SimpleNamespace(
+        sender=None, days=None, dry_run=False, batch_size=100, no_backup=False, unsubscribe=None
     )
-    parser.add_argument('--sender', type=str, help='Email отправителя')
-    parser.add_argument('--days', type=int, help='Письма старше N дней')
-    parser.add_argument('--dry-run', action='store_true', help='Режим без удаления')
-    parser.add_argument('--batch-size', type=int, default=100, help='Размер батча')
-    parser.add_argument('--no-backup', action='store_true', help='Отключить auto-backup')
-    parser.add_argument('--unsubscribe', type=str, help='Отписаться от рассылки (email)')
+    argv = iter(sys.argv[1:])
+    unknown = []
     
-    return parser.parse_args()
+    for arg in argv:
+        flag, has_value, value = arg.partition('=')
+        flag = _resolve_cli_flag(prog, flag)
+        
+        if flag in ('-h', '--help'):
+            print(_CLI_USAGE.format(prog=prog, pad=' ' * len(prog)))
+            print(_CLI_HELP)
+            sys.exit(0)
+        
+        option = _CLI_OPTIONS.get(flag)
+        if option is None:
+            unknown.append(arg)
+            continue
+        
+        attr, value_type = option
+        if value_type is None:
+            if has_value:
+                _cli_error(prog, f"argument {flag}: ignored explicit argument '{value}'")
+            setattr(args, attr, True)
+            continue
+        
+        if not has_value:
+            value = next(argv, None)
+            if value is None or value.startswith('--'):
+                _cli_error(prog, f"argument {flag}: expected one argument")
+        try:
+            setattr(args, attr, value_type(value))
+        except ValueError:
+            _cli_error(prog, f"argument {flag}: invalid {value_type.__name__} value: '{value}'")
+    
+    if unknown:
+        _cli_error(prog, f"unrecognized arguments: {' '.join(unknown)}")
+    
+    return args
 
 
 # ==================== MAIN ====================
@@ -901,11 +1696,14 @@ def main():
         'use_batch_delete': True
     }
     
-    cleaner = GmailCleanerPro(config=config_override)
-    
-    print("="*60)
-    print("      📧 GMAIL CLEANER PRO v2.1 - Полностью рабочий скрипт 🚀")
-    print("="*60)
+    # Пулы потоков и sqlite-кэш закрываются при любом выходе (main() можно вызывать повторно)
+    with GmailCleanerPro(config=config_override) as cleaner:
+        _run_cleaner(cleaner, args)
+
+
+def _run_cleaner(cleaner: GmailCleanerPro, args: SimpleNamespace):
+    """Работа с готовым клиентом: одноразовый CLI-режим или интерактивный цикл."""
+    print(_STARTUP_BANNER)
     
     try:
         cleaner.authenticate_gmail_api()
@@ -943,11 +1741,12 @@ def main():
         display_top_senders(sender_df)
     
     while True:
-        print("\n" + "="*70)
-        print("          ✨ ГОТОВНОСТЬ К ЧИСТКЕ (Введите 'q' для выхода)")
-        print("="*70)
+        print(_LOOP_BANNER)
         
-        sender_input = input("Email/домен отправителя для чистки (или 'q', 'top', 'unsub'): ").strip()
+        sender_input = input(
+            "Email/домен отправителя для чистки (или 'q', 'top', 'unsub'; "
+            "всё сразу: отправитель|дни|МБ|доп.): "
+        ).strip()
         
         if sender_input.lower() in ['q', 'exit', 'quit']:
             print("👋 Завершение работы программы.")
@@ -965,18 +1764,25 @@ def main():
             if unsub_email:
                 cleaner.interactive_unsubscribe(unsub_email)
             continue
+        
+        # Краткая форма «отправитель|дни|МБ|доп.» — без остальных вопросов
+        shorthand = '|' in sender_input
+        if shorthand:
+            sender_input, days, size, additional_query = (
+                part.strip() for part in (sender_input.split('|', 3) + ['', '', ''])[:4]
+            )
             
         if not sender_input:
             print("⚠️ Не указан отправитель. Попробуйте снова.")
             continue
-            
-        days = input("Письма старше N дней (пусто — все): ").strip()
-        days_ago = int(days) if days.isdigit() else None
         
-        size = input("Письма крупнее N МБ (пусто — все): ").strip()
-        min_size_mb = float(size) if size.replace('.', '', 1).isdigit() else None
+        if not shorthand:
+            days = input("Письма старше N дней (пусто — все): ").strip()
+            size = input("Письма крупнее N МБ (пусто — все): ").strip()
+            additional_query = input("Дополнительно (например, 'subject:ads' или пусто): ").strip()
         
-        additional_query = input("Дополнительно (например, 'subject:ads' или пусто): ").strip()
+        days_ago = int(days) if _INT_RE.fullmatch(days) else None
+        min_size_mb = float(size) if _FLOAT_RE.fullmatch(size) else None
 
         query = cleaner.build_search_query(
             sender_email=sender_input, 